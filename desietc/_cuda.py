@@ -0,0 +1,123 @@
+"""CUDA kernels for the hot loops of guide frame processing.
+
+This module requires numba with CUDA support and should only be imported via a
+guarded import, so that the CPU implementations can be used when no GPU is available.
+"""
+import math
+
+import numpy as np
+
+from numba import cuda, float32, float64
+
+
+# Maximum number of pixels per stamp that can be staged in shared memory.
+# The default guide_pixels=31 stamps have 961 pixels.
+MAX_PIXELS = 1024
+
+# Number of dithers processed by each thread block.
+BLOCK_SIZE = 128
+
+
+def is_available():
+    """Return True if a CUDA device (or the CUDA simulator) can be used.
+    """
+    return cuda.is_available()
+
+
+def to_device(dithered):
+    """Copy an array of shape (ndither, ...) of dithered templates to the GPU.
+
+    Returns a device array of shape (ndither, npixels) that can be passed to
+    :func:`fit_dither` for each guide frame without copying it again.
+    """
+    return cuda.to_device(np.ascontiguousarray(dithered, np.float32).reshape(len(dithered), -1))
+
+
+@cuda.jit
+def fit_dither_cuda(dithered, Dstack, Wstack, area, out_nll, out_flux, out_bg):
+    """Fit each dithered template to each stamp with a floating flux and background.
+
+    Launched on a grid of (ceil(ndither / BLOCK_SIZE), nstamp) blocks. The threads of
+    each block cooperatively load one stamp into shared memory, then each thread
+    solves the 2x2 normal equations for one (dither, stamp) pair. Sums are accumulated
+    in float64, with the same results as :func:`desietc._kernels.fit_dither_nb`.
+
+    Parameters
+    ----------
+    dithered : array
+        2D array of shape (ndither, npixels) with the dithered templates.
+    Dstack : array
+        2D array of shape (nstamp, npixels) with the observed pixel values.
+    Wstack : array
+        2D array of shape (nstamp, npixels) with the pixel inverse variances.
+    area : array
+        1D array of npixels pixel areas used to predict the background.
+    out_nll : array
+        2D array of shape (ndither, nstamp) where the NLL values are written.
+    out_flux : array
+        2D array of shape (ndither, nstamp) where the best-fit fluxes are written.
+    out_bg : array
+        2D array of shape (ndither, nstamp) where the best-fit background
+        densities are written.
+    """
+    D = cuda.shared.array(MAX_PIXELS, float32)
+    W = cuda.shared.array(MAX_PIXELS, float32)
+    A = cuda.shared.array(MAX_PIXELS, float64)
+    ndither, npixels = dithered.shape
+    s = cuda.blockIdx.y
+    tid = cuda.threadIdx.x
+    # Stage this block's stamp in shared memory.
+    for p in range(tid, npixels, cuda.blockDim.x):
+        D[p] = Dstack[s, p]
+        W[p] = Wstack[s, p]
+        A[p] = area[p]
+    cuda.syncthreads()
+    d = cuda.blockIdx.x * cuda.blockDim.x + tid
+    if d >= ndither:
+        return
+    M11 = M12 = A1 = float64(0.)
+    M22 = A2 = WDD = float64(0.)
+    for p in range(npixels):
+        m = float64(dithered[d, p])
+        w = float64(W[p])
+        a = A[p]
+        wm = w * m
+        wd = w * D[p]
+        M11 += wm * m
+        M12 += wm * a
+        A1 += wm * D[p]
+        M22 += w * a * a
+        A2 += wd * a
+        WDD += wd * D[p]
+    det = M11 * M22 - M12 * M12
+    flux = (M22 * A1 - M12 * A2) / det
+    bg = (M11 * A2 - M12 * A1) / det
+    out_flux[d, s] = flux
+    out_bg[d, s] = bg
+    out_nll[d, s] = 0.5 * (WDD - flux * A1 - bg * A2)
+
+
+def fit_dither(dithered, data, ivar, area, out_nll, out_flux, out_bg):
+    """Launch :func:`fit_dither_cuda` on host arrays and copy the results back.
+
+    Takes the same arguments as :func:`desietc._kernels.fit_dither_nb`, except that
+    dithered can also be a device array returned by :func:`to_device`.
+    """
+    ndither, npixels = dithered.shape
+    nstamp = data.shape[0]
+    if npixels > MAX_PIXELS:
+        raise ValueError(f'Stamps with {npixels} pixels exceed MAX_PIXELS={MAX_PIXELS}.')
+    stream = cuda.stream()
+    if isinstance(dithered, np.ndarray):
+        d_dithered = cuda.to_device(np.ascontiguousarray(dithered, np.float32), stream=stream)
+    else:
+        d_dithered = dithered
+    d_data = cuda.to_device(np.ascontiguousarray(data, np.float32), stream=stream)
+    d_ivar = cuda.to_device(np.ascontiguousarray(ivar, np.float32), stream=stream)
+    d_area = cuda.to_device(np.ascontiguousarray(area, np.float64), stream=stream)
+    d_out = [cuda.device_array((ndither, nstamp), np.float64, stream=stream) for i in range(3)]
+    grid = (math.ceil(ndither / BLOCK_SIZE), nstamp)
+    fit_dither_cuda[grid, BLOCK_SIZE, stream](d_dithered, d_data, d_ivar, d_area, *d_out)
+    for d_arr, out in zip(d_out, (out_nll, out_flux, out_bg)):
+        d_arr.copy_to_host(out, stream=stream)
+    stream.synchronize()
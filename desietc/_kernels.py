@@ -0,0 +1,65 @@
+"""Numba-compiled kernels for the hot loops of guide frame processing.
+
+This module requires numba and should only be imported via a guarded import,
+so that the pure numpy implementations can be used when numba is not installed.
+"""
+import numpy as np
+
+from numba import njit, prange
+
+
+@njit(cache=True, parallel=True, fastmath=True, nogil=True)
+def fit_dither_nb(dithered, data, ivar, area, out_nll, out_flux, out_bg):
+    """Fit each dithered template to each stamp with a floating flux and background.
+
+    All pixel arrays are flattened along their last axis. The best-fit flux and
+    background density for each (dither, stamp) pair are obtained by solving the
+    2x2 normal equations, whose elements are accumulated in a single pass over
+    the template and stamp pixels, without allocating any temporary arrays.
+
+    Parameters
+    ----------
+    dithered : array
+        2D array of shape (ndither, npixels) with the dithered templates.
+    data : array
+        2D array of shape (nstamp, npixels) with the observed pixel values.
+    ivar : array
+        2D array of shape (nstamp, npixels) with the pixel inverse variances.
+    area : array
+        1D array of npixels pixel areas used to predict the background.
+    out_nll : array
+        2D array of shape (ndither, nstamp) where the NLL values are written.
+    out_flux : array
+        2D array of shape (ndither, nstamp) where the best-fit fluxes are written.
+    out_bg : array
+        2D array of shape (ndither, nstamp) where the best-fit background
+        densities are written.
+    """
+    ndither, npixels = dithered.shape
+    nstamp = data.shape[0]
+    # Calculate the sums that do not depend on the dither.
+    M22 = np.zeros(nstamp)
+    A2 = np.zeros(nstamp)
+    WDD = np.zeros(nstamp)
+    for s in range(nstamp):
+        for p in range(npixels):
+            w = np.float64(ivar[s, p])
+            wd = w * data[s, p]
+            M22[s] += w * area[p] * area[p]
+            A2[s] += wd * area[p]
+            WDD[s] += wd * data[s, p]
+    for d in prange(ndither):
+        for s in range(nstamp):
+            M11 = M12 = A1 = 0.
+            for p in range(npixels):
+                m = np.float64(dithered[d, p])
+                wm = ivar[s, p] * m
+                M11 += wm * m
+                M12 += wm * area[p]
+                A1 += wm * data[s, p]
+            det = M11 * M22[s] - M12 * M12
+            flux = (M22[s] * A1 - M12 * A2[s]) / det
+            bg = (M11 * A2[s] - M12 * A1) / det
+            out_flux[d, s] = flux
+            out_bg[d, s] = bg
+            out_nll[d, s] = 0.5 * (WDD[s] - flux * A1 - bg * A2[s])
@@ -5,6 +5,8 @@ import json
 import pathlib
 import datetime
 import multiprocessing
+import concurrent.futures
+import threading
 try:
     import multiprocessing.shared_memory
     shared_memory_available = True
@@ -38,7 +40,8 @@ class ETCAlgorithm(object):
 
     def __init__(self, sky_calib, gfa_calib, psf_pixels=25, guide_pixels=31, max_dither=7, num_dither=1200,
                  Ebv_coef=2.165, X_coef=0.114, ffrac_ref=0.56, nbad_threshold=100, nll_threshold=100,
-                 avg_secs=60, avg_min_values=3, grid_resolution=0.5, min_exptime_secs=0, parallel=True):
+                 avg_secs=60, avg_min_values=3, grid_resolution=0.5, min_exptime_secs=0, parallel=True,
+                 backend='cpu'):
         """Initialize once per session.
 
         Parameters
@@ -82,7 +85,24 @@ class ETCAlgorithm(object):
             the spectrograph shutters open.
         parallel : bool
             Process GFA images in parallel when True.
+        backend : str
+            Either 'cpu' or 'cuda'. Use 'cuda' to fit guide stars on a GPU, when one
+            is available. Falls back to 'cpu' when no GPU is available or the guide
+            star stamps are too large for the GPU kernel.
         """
+        if backend not in ('cpu', 'cuda'):
+            raise ValueError(f'Invalid backend: {backend}.')
+        if backend == 'cuda':
+            if not desietc.gmm.init_cuda():
+                logging.warning('No CUDA device available: guide stars will be fit on the CPU.')
+                backend = 'cpu'
+            else:
+                import desietc._cuda as cuda_kernels
+                if guide_pixels ** 2 > cuda_kernels.MAX_PIXELS:
+                    logging.warning(f'guide_pixels={guide_pixels} is too large for the CUDA kernel: ' +
+                                    'guide stars will be fit on the CPU.')
+                    backend = 'cpu'
+        self.backend = backend
         self.Ebv_coef = Ebv_coef
         self.X_coef = X_coef
         self.nbad_threshold = nbad_threshold
@@ -125,7 +145,12 @@ class ETCAlgorithm(object):
         self.num_guide_frames = 0
         self.num_sky_frames = 0
         self.acquisition_data = None
+        self.dithered_model = None
+        self.dithered_device = {}
         self.guide_stars = None
+        self.stamp_bbox = {}
+        self.dark_cache = {}
+        self.dark_cache_lock = threading.Lock()
         self.image_path = None
         # Initialize observing conditions updated after each GFA or SKY frame.
         self.seeing = None
@@ -190,6 +215,7 @@ class ETCAlgorithm(object):
         self.SKY = desietc.sky.SkyCamera(calib_name=sky_calib)
         # Prepare for parallel processing if necessary.
         self.GFAs = {}
+        self.guide_pool = None
         self.parallel = parallel
         if parallel:
             # Check that shared mem is available.
@@ -241,6 +267,11 @@ class ETCAlgorithm(object):
                         camera, self.gfa_calib, self.GMMpsf, self.psf_inset, self.measure, child))
                 self.processes[camera].start()
         logging.info(f'Initialized {len(self.GFAs)} GFA processes.')
+        # Initialize a thread pool to process guide frames from each GFA concurrently.
+        if self.guide_pool is None:
+            desietc.gmm.init_kernels()
+            self.guide_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(self.GFAs), thread_name_prefix='ETC-guide')
 
     def shutdown(self, timeout=5):
         """Release any resources allocated in our constructor.
@@ -248,6 +279,10 @@ class ETCAlgorithm(object):
         if not self.parallel:
             return
         logging.info('Shutting down ETC...')
+        # Shutdown the guide frame thread pool.
+        if self.guide_pool is not None:
+            self.guide_pool.shutdown(wait=True)
+            self.guide_pool = None
         # Shutdown the process and release the shared memory allocated for each GFA.
         for camera in desietc.gfa.GFACamera.guide_names:
             logging.info(f'Releasing {camera} resources')
@@ -457,6 +492,7 @@ class ETCAlgorithm(object):
         badfit = []
         fwhm_vec, ffrac_vec = [], []
         self.dithered_model = {}
+        self.dithered_device = {}
         psf_model = {}
         for camera, camera_result in self.acquisition_data.items():
             nstars[camera] = camera_result['nstar']
@@ -475,7 +511,13 @@ class ETCAlgorithm(object):
                 continue
             psf_model[camera] = self.GMMpsf.predict(gmm_params)
             # Precompute dithered renderings of the model for fast guide frame fits.
+            # A single read-only model is shared by all guide stars on this camera.
             self.dithered_model[camera] = self.GMMguide.dither(gmm_params, self.xdither, self.ydither)
+            self.dithered_model[camera].flags.writeable = False
+            if self.backend == 'cuda':
+                # Keep a copy on the GPU that is reused for every guide frame.
+                import desietc._cuda as cuda_kernels
+                self.dithered_device[camera] = cuda_kernels.to_device(self.dithered_model[camera])
         # Update the current FWHM, FFRAC values now.
         self.seeing, ffrac_psf = 0., 0.
         if np.any(np.isfinite(fwhm_vec)):
@@ -498,6 +540,7 @@ class ETCAlgorithm(object):
         # Reset the guide frame counter and guide star data.
         self.num_guide_frames = 0
         self.guide_stars = None
+        self.stamp_bbox = {}
         # Report timing.
         elapsed = time.time() - start
         logging.info(f'Acquisition processing took {elapsed:.2f}s for {ncamera} cameras.')
@@ -514,6 +557,10 @@ class ETCAlgorithm(object):
         halfsize = self.guide_pixels // 2
         self.guide_stars = {}
         self.fiber_templates = {}
+        self.fiber_overlaps = {}
+        self.stamp_index = {}
+        self.stamp_buffer = {}
+        self.stamp_bbox = {}
         nstars = []
         _, ny, nx = desietc.gfa.GFACamera.buffer_shape
         for camera in desietc.gfa.GFACamera.guide_names:
@@ -522,36 +569,36 @@ class ETCAlgorithm(object):
                 logging.warning(f'No guide stars available for {camera}.')
                 nstars.append(0)
                 continue
+            # Convert from PlateMaker indexing convention to (0,0) centered in bottom-left pixel.
+            idx = np.where(sel)[0]
+            x0 = pm_info['COL'][idx] - 0.5
+            y0 = pm_info['ROW'][idx] - 0.5
+            rmag = pm_info['MAG'][idx]
+            # Convert flux to predicted detected electrons per second in the
+            # GFA filter with nominal zenith atmospheric transmission.
+            nelec_rate = 10 ** (-(rmag - zeropoint) / 2.5)
+            # Calculate the stamp bounds to extract each star in each guide frame.
+            iy, ix = np.round(y0).astype(int), np.round(x0).astype(int)
+            ylo, yhi = iy - halfsize, iy + halfsize + 1
+            xlo, xhi = ix - halfsize, ix + halfsize + 1
+            inside = (ylo >= 0) & (yhi <= ny) & (xlo >= 0) & (xhi <= nx)
+            ndrop = len(inside) - np.count_nonzero(inside)
+            if ndrop > 0:
+                logging.info(f'Dropped {ndrop} {camera} stars too close to the border.')
             # Loop over guide stars for this GFA.
             stars = []
             templates = []
-            for i in np.where(sel)[0]:
-                # Convert from PlateMaker indexing convention to (0,0) centered in bottom-left pixel.
-                x0 = pm_info[i]['COL'] - 0.5
-                y0 = pm_info[i]['ROW'] - 0.5
-                RA = pm_info[i]['RA']
-                DEC = pm_info[i]['DEC']
-                rmag = pm_info[i]['MAG']
-                # Convert flux to predicted detected electrons per second in the
-                # GFA filter with nominal zenith atmospheric transmission.
-                nelec_rate = 10 ** (-(rmag - zeropoint) / 2.5)
-                # Prepare slices to extract this star in each guide frame.
-                iy, ix = np.round(y0).astype(int), np.round(x0).astype(int)
-                ylo, yhi = iy - halfsize, iy + halfsize + 1
-                xlo, xhi = ix - halfsize, ix + halfsize + 1
-                if ylo < 0 or yhi > ny or xlo < 0 or xhi > nx:
-                    logging.info(f'Skipping stamp too close to border at ({x0},{y0})')
-                    continue
-                yslice, xslice = (ylo, yhi), (xlo, xhi)
+            for k in np.where(inside)[0]:
+                i = idx[k]
                 # Calculate an antialiased fiber template for FFRAC calculations.
-                fiber_dx, fiber_dy = x0 - ix, y0 - iy
-                fiber = desietc.gfa.get_fiber_profile(x0, y0, camera, self.guide_pixels)
+                fiber_dx, fiber_dy = x0[k] - ix[k], y0[k] - iy[k]
+                fiber = desietc.gfa.get_fiber_profile(x0[k], y0[k], camera, self.guide_pixels).astype(np.float32)
                 stars.append(dict(
-                    x0=np.float32(x0), y0=np.float32(y0), rmag=np.float32(rmag),
-                    RA=np.float32(RA), DEC=np.float32(DEC),
-                    nelec_rate=np.float32(nelec_rate),
+                    x0=np.float32(x0[k]), y0=np.float32(y0[k]), rmag=np.float32(rmag[k]),
+                    RA=np.float32(pm_info['RA'][i]), DEC=np.float32(pm_info['DEC'][i]),
+                    nelec_rate=np.float32(nelec_rate[k]),
                     fiber_dx=np.float32(fiber_dx), fiber_dy=np.float32(fiber_dy),
-                    yslice=yslice, xslice=xslice))
+                    yslice=(int(ylo[k]), int(yhi[k])), xslice=(int(xlo[k]), int(xhi[k]))))
                 # Save the template separately from the stars info since we do not want
                 # to archive it in the ETC json output.
                 templates.append(fiber)
@@ -559,6 +606,26 @@ class ETCAlgorithm(object):
             if len(stars) > 0:
                 self.guide_stars[camera] = stars
                 self.fiber_templates[camera] = templates
+                # Precompute flattened pixel indices to gather all stamps with a single take().
+                offsets = np.arange(self.guide_pixels)
+                ylo = np.array([star['yslice'][0] for star in stars]).reshape(-1, 1, 1)
+                xlo = np.array([star['xslice'][0] for star in stars]).reshape(-1, 1, 1)
+                self.stamp_index[camera] = (
+                    (ylo + offsets.reshape(-1, 1)) * nx + xlo + offsets).reshape(len(stars), -1).astype(np.int32)
+                # Record the bounding box of all stamps, so that only the pixels within it
+                # need to be read and preprocessed.
+                self.stamp_bbox[camera] = (
+                    int(ylo.min()), int(ylo.max()) + self.guide_pixels,
+                    int(xlo.min()), int(xlo.max()) + self.guide_pixels)
+                # Allocate buffers for the data and ivar stamps that are reused for each guide frame.
+                self.stamp_buffer[camera] = np.empty((2,) + self.stamp_index[camera].shape, np.float32)
+                if self.dithered_model is not None and camera in self.dithered_model:
+                    # Precompute the overlap of each fiber template with each dithered PSF model
+                    # so that the fiber fraction of a guide frame fit is a simple lookup.
+                    dithered = self.dithered_model[camera]
+                    self.fiber_overlaps[camera] = np.dot(
+                        np.stack(templates).reshape(len(templates), -1),
+                        dithered.reshape(len(dithered), -1).T).astype(np.float32)
         if len(self.guide_stars) == 0:
             logging.error(f'No usable guide stars for {self.exptag}.')
             return False
@@ -568,10 +635,86 @@ class ETCAlgorithm(object):
         logging.info(f'Using {nstars_msg} guide stars for {self.exptag}.')
         return True
 
+    def process_guide_camera(self, camera, data, exptime, fnum):
+        """Process the guide frame from a single camera.
+
+        This method only updates state that belongs to this camera, so that
+        different cameras can be processed concurrently when each has its own
+        GFACamera object. Returns a dictionary of per-star and per-camera
+        results, or None if this camera's data could not be used.
+        """
+        # Only preprocess the pixels covered by this camera's guide star stamps, if known.
+        window = self.stamp_bbox.get(camera)
+        if not self.preprocess_gfa(camera, data, f'{camera}[{fnum}]', exptime=exptime, window=window):
+            return None
+        thisGFA = self.GFAs[camera]
+        stars = self.guide_stars[camera]
+        dithered = self.dithered_model[camera]
+        # Extract the postage stamps for all guide stars on this camera.
+        stamp_index, stamp_buffer = self.stamp_index[camera], self.stamp_buffer[camera]
+        np.take(thisGFA.data.reshape(-1), stamp_index, out=stamp_buffer[0])
+        np.take(thisGFA.ivar.reshape(-1), stamp_index, out=stamp_buffer[1])
+        stamp_shape = (len(stars), self.guide_pixels, self.guide_pixels)
+        Dstack = stamp_buffer[0].reshape(stamp_shape)
+        Wstack = stamp_buffer[1].reshape(stamp_shape)
+
+        ###### Original PSF model fit
+
+        # Estimate the actual centroid in pixels, flux in electrons and
+        # constant background level in electrons / pixel for all stars at once.
+        fit_dx, fit_dy, fit_flux, fit_bg, fit_nll, fit_kmin = self.GMMguide.fit_dithered_batch(
+            self.xdither, self.ydither, dithered, Dstack, Wstack, backend=self.backend,
+            dithered_device=self.dithered_device.get(camera))
+        # Lookup the fiber fraction of each star's best-fit dithered model.
+        fit_ffrac = self.fiber_overlaps[camera][np.arange(len(stars)), fit_kmin]
+        # Loop over guide stars for this camera.
+        nstars = len(stars)
+        star_fluxsum = np.zeros(nstars)
+        star_profsum = np.zeros(nstars)
+        star_fluxnorm = np.zeros(nstars)
+        star_ffracs = np.zeros((nstars, 3))
+        star_ffrac, star_transp, star_dx, star_dy = [], [], [], []
+        templates = self.fiber_templates[camera]
+        for istar, star in enumerate(stars):
+            D, DW = Dstack[istar], Wstack[istar]
+            FIBER = templates[istar]
+            fluxnorm = star['nelec_rate'] * exptime
+            flux, ffrac = fit_flux[istar], fit_ffrac[istar]
+            # Calculate centroid offset relative to the target fiber center.
+            dx = fit_dx[istar] - star['fiber_dx']
+            dy = fit_dy[istar] - star['fiber_dy']
+            # Calculate the transparency as the ratio of measured / predicted electrons.
+            transp = flux / fluxnorm
+            star_transp.append(transp)
+            star_ffrac.append(ffrac)
+            star_dx.append(dx)
+            star_dy.append(dy)
+
+            ###### New pixel-level analysis
+
+            # Blur by 0.15 pixel to reduce artifacts from isolated pixels with large ivar.
+            D, DW = desietc.util.blur(D, DW)
+            # Estimate and subtract the flat background level.
+            bg_per_pixel = desietc.util.robust_median(D[self.BGmask])
+            D -= bg_per_pixel
+            # Sum the signal flux over the full stamp.
+            star_fluxsum[istar] = D.sum(dtype=np.float64)
+            # Sum the signal flux over the fiber profile.
+            star_profsum[istar] = (D * FIBER).sum(dtype=np.float64)
+            # Calculate fiber fractions.
+            star_ffracs[istar] = desietc.util.get_fiber_fractions(D, FIBER)
+            # Calculate the expected total PSF flux with transparency=1.
+            star_fluxnorm[istar] = fluxnorm
+            #logging.debug(f'{camera}[{fnum}] {star_fluxsum[istar]:.1f} {star_profsum[istar]:.1f} {star_fluxnorm[istar]:.1f} {star_ffracs[istar][0]:.4f} {star_ffracs[istar][1]:.4f} {star_ffracs[istar][2]:.4f}')
+
+        return dict(
+            fluxsum=star_fluxsum, profsum=star_profsum, fluxnorm=star_fluxnorm, ffracs=star_ffracs,
+            transp=np.nanmedian(star_transp), ffrac=np.nanmedian(star_ffrac),
+            dx=np.nanmean(star_dx), dy=np.nanmean(star_dy))
+
     def process_guide_frame(self, data, timestamp):
         """Process a guide frame.
         """
-        ncamera = nstar = 0
         start = time.time()
         fnum = self.num_guide_frames
         self.num_guide_frames += 1
@@ -584,20 +727,12 @@ class ETCAlgorithm(object):
         if self.guide_stars is None:
             logging.error('Ignoring guide frame before guide stars.')
             return False
-        nstars_tot = self.exp_data['nstars']
-        star_fluxsum = np.zeros(nstars_tot)
-        star_profsum = np.zeros(nstars_tot)
-        star_fluxnorm = np.zeros(nstars_tot)
-        star_ffracs = np.zeros((nstars_tot, 3))
-        # Loop over cameras with acquisition results.
-        mjd_obs, exptime, camera_transp, camera_ffrac = [], [], [], []
-        each_ffrac, each_transp = np.zeros(self.ngfa, np.float32), np.zeros(self.ngfa, np.float32)
-        each_dx, each_dy = np.zeros(self.ngfa, np.float32), np.zeros(self.ngfa, np.float32)
-        for icam, camera in enumerate(desietc.gfa.GFACamera.guide_names):
+        # Check the headers of cameras with acquisition results.
+        camera_mjd_obs, camera_exptime, cameras = {}, {}, []
+        for camera in desietc.gfa.GFACamera.guide_names:
             if camera not in self.dithered_model:
                 # We do not have acquisition results for this camera.
                 continue
-            dithered = self.dithered_model[camera]
             if camera not in self.guide_stars:
                 logging.debug(f'Skipping {camera} guide frame {fnum} with no guide stars.')
                 continue
@@ -606,70 +741,51 @@ class ETCAlgorithm(object):
                 continue
             if not self.process_camera_header(data[camera]['header'], f'{camera}[{fnum}]'):
                 continue
-            if not self.preprocess_gfa(camera, data[camera], f'{camera}[{fnum}]'):
+            camera_mjd_obs[camera], camera_exptime[camera] = self.mjd_obs, self.exptime
+            cameras.append(camera)
+        # Process each camera, concurrently if we have a pool of threads.
+        results = {}
+        if self.guide_pool is not None:
+            futures = {
+                self.guide_pool.submit(
+                    self.process_guide_camera, camera, data[camera], camera_exptime[camera], fnum): camera
+                for camera in cameras}
+            for future in concurrent.futures.as_completed(futures):
+                results[futures[future]] = future.result()
+        else:
+            for camera in cameras:
+                results[camera] = self.process_guide_camera(camera, data[camera], camera_exptime[camera], fnum)
+        # Combine the per-camera results in a fixed camera order.
+        nstars_tot = self.exp_data['nstars']
+        star_fluxsum = np.zeros(nstars_tot)
+        star_profsum = np.zeros(nstars_tot)
+        star_fluxnorm = np.zeros(nstars_tot)
+        star_ffracs = np.zeros((nstars_tot, 3))
+        each_ffrac, each_transp = np.zeros(self.ngfa, np.float32), np.zeros(self.ngfa, np.float32)
+        each_dx, each_dy = np.zeros(self.ngfa, np.float32), np.zeros(self.ngfa, np.float32)
+        ncamera = nstar = 0
+        mjd_obs, exptime = [], []
+        for icam, camera in enumerate(desietc.gfa.GFACamera.guide_names):
+            result = results.get(camera, None)
+            if result is None:
                 continue
-            thisGFA = self.GFAs[camera]
-            # Loop over guide stars for this camera.
-            star_ffrac, star_transp, star_dx, star_dy = [], [], [], []
-            templates = self.fiber_templates[camera]
-            for istar, star in enumerate(self.guide_stars[camera]):
-                # Extract the postage stamp for this star.
-                xslice, yslice = slice(*star['xslice']), slice(*star['yslice'])
-                D = thisGFA.data[yslice, xslice]
-                DW = thisGFA.ivar[yslice, xslice]
-                FIBER = templates[istar]
-                fluxnorm = star['nelec_rate'] * self.exptime
-
-                ###### Original PSF model fit
-
-                # Estimate the actual centroid in pixels, flux in electrons and
-                # constant background level in electrons / pixel.
-                dx, dy, flux, bg, nll, best_fit = self.GMMguide.fit_dithered(
-                    self.xdither, self.ydither, dithered, D, DW)
-                # Calculate centroid offset relative to the target fiber center.
-                dx -= star['fiber_dx']
-                dy -= star['fiber_dy']
-                # Calculate the corresponding fiber fraction for this star.
-                ffrac = np.sum(FIBER * best_fit)
-                # Calculate the transparency as the ratio of measured / predicted electrons.
-                transp = flux / fluxnorm
-                star_transp.append(transp)
-                star_ffrac.append(ffrac)
-                star_dx.append(dx)
-                star_dy.append(dy)
-
-                ###### New pixel-level analysis
-
-                # Blur by 0.15 pixel to reduce artifacts from isolated pixels with large ivar.
-                D, DW = desietc.util.blur(D, DW)
-                # Estimate and subtract the flat background level.
-                bg_per_pixel = desietc.util.robust_median(D[self.BGmask])
-                D -= bg_per_pixel
-                # Sum the signal flux over the full stamp.
-                star_fluxsum[nstar] = D.sum()
-                # Sum the signal flux over the fiber profile.
-                star_profsum[nstar] = (D * FIBER).sum()
-                # Calculate fiber fractions.
-                star_ffracs[nstar] = desietc.util.get_fiber_fractions(D, FIBER)
-                # Calculate the expected total PSF flux with transparency=1.
-                star_fluxnorm[nstar] = fluxnorm
-                #logging.debug(f'{camera}[{fnum}] {star_fluxsum[-1]:.1f} {star_profsum[-1]:.1f} {star_fluxnorm[-1]:.1f} {star_ffracs[-1][0]:.4f} {star_ffracs[-1][1]:.4f} {star_ffracs[-1][2]:.4f}')
-
-                nstar += 1
-
-            camera_transp.append(np.nanmedian(star_transp))
-            camera_ffrac.append(np.nanmedian(star_ffrac))
+            n = len(result['fluxnorm'])
+            star_fluxsum[nstar:nstar + n] = result['fluxsum']
+            star_profsum[nstar:nstar + n] = result['profsum']
+            star_fluxnorm[nstar:nstar + n] = result['fluxnorm']
+            star_ffracs[nstar:nstar + n] = result['ffracs']
+            nstar += n
             # Prepare the auxiliary data saved to the ETC json file.
-            if len(star_dx) > 0:
-                each_ffrac[icam] = camera_ffrac[-1]
-                each_transp[icam] = camera_transp[-1]
-                each_dx[icam] = np.nanmean(star_dx)
-                each_dy[icam] = np.nanmean(star_dy)
+            if n > 0:
+                each_ffrac[icam] = result['ffrac']
+                each_transp[icam] = result['transp']
+                each_dx[icam] = result['dx']
+                each_dy[icam] = result['dy']
                 logging.debug(
                     f'{camera}[{fnum}] ffrac={each_ffrac[icam]:.3f} transp={each_transp[icam]:.3f} ' +
-                    f'dx={each_dx[icam]:.2f} dy={each_dy[icam]:.2f} nstar={len(star_dx)}.')
-            mjd_obs.append(self.mjd_obs)
-            exptime.append(self.exptime)
+                    f'dx={each_dx[icam]:.2f} dy={each_dy[icam]:.2f} nstar={n}.')
+            mjd_obs.append(camera_mjd_obs[camera])
+            exptime.append(camera_exptime[camera])
             ncamera += 1
         # Did we get any useful data?
         if ncamera == 0:
@@ -793,7 +909,7 @@ class ETCAlgorithm(object):
             if raw_data.shape != (2047, 3072):
                 logging.error(f'Invalid {camera} image shape for frame {fnum}.')
                 continue
-            if np.all(raw_data == 0):
+            if not np.any(raw_data):
                 logging.warning(f'Ignoring {camera} all-zero image for frame {fnum}.')
                 continue
             camera_flux, camera_dflux = self.SKY.setraw(raw_data, name=camera)
@@ -850,11 +966,40 @@ class ETCAlgorithm(object):
             exptime_all = np.nanmedian(exptime)
         return (mjd_obs_all, mjd_obs_all + exptime_all / self.SECS_PER_DAY)
 
-    def preprocess_gfa(self, camera, data, source, default_ccdtemp=10):
+    def get_dark_current(self, camera, ccdtemp, exptime, max_cache_size=16):
+        """Return the predicted dark current image in electrons for the specified GFA.
+        Images are cached since the temperature changes slowly and the exposure time is
+        normally fixed during a guide sequence, so the returned array is read only.
+        Safe to call concurrently for different cameras.
+        """
+        key = (camera, round(float(ccdtemp), 1), round(float(exptime), 3))
+        with self.dark_cache_lock:
+            dark = self.dark_cache.pop(key, None)
+            if dark is not None:
+                # Move this image to the end so the least recently used image is evicted first.
+                self.dark_cache[key] = dark
+        if dark is None:
+            # Calculate the image outside the lock so other cameras are not blocked.
+            dark = self.GFAs[camera].get_dark_current(key[1], key[2], name=camera)
+            dark.flags.writeable = False
+            with self.dark_cache_lock:
+                if key not in self.dark_cache and len(self.dark_cache) >= max_cache_size:
+                    # Drop the least recently used image.
+                    self.dark_cache.pop(next(iter(self.dark_cache)))
+                self.dark_cache[key] = dark
+        return dark
+
+    def preprocess_gfa(self, camera, data, source, default_ccdtemp=10, exptime=None, window=None):
         """Preprocess raw data for the specified GFA.
         Returns False with a log message in case of any problems.
         Otherwise, GFA.data and GFA.ivar are corrected for bias,
         dark-current and and bad pixels.
+        Uses the most recent header EXPTIME unless exptime is specified.
+        When data includes a row0 value, the raw data is a band of full-width
+        rows starting at row0 and only these rows are processed. The bias is then
+        estimated from the full-height overscan columns if data includes them.
+        When window is specified, only the GFA.data and GFA.ivar pixels within
+        its (ylo, yhi, xlo, xhi) bounds are updated.
         """
         hdr = data['header']
         ccdtemp = hdr.get('GCCDTEMP', None)
@@ -863,14 +1008,17 @@ class ETCAlgorithm(object):
             logging.warning(f'Using default GCCDTEMP {ccdtemp}C for {source}')
         try:
             thisGFA = self.GFAs[camera]
-            if np.all(data['data'] == 0):
+            if not np.any(data['data']):
                 logging.warning(f'Ignoring {source} raw data that is all zeros.')
                 return False
-            thisGFA.setraw(data['data'], name=camera)
+            if exptime is None:
+                exptime = self.exptime
+            dark = self.get_dark_current(camera, ccdtemp, exptime)
+            thisGFA.setraw(data['data'], name=camera, row0=data.get('row0', 0), dark=dark,
+                           overscan=data.get('overscan'), window=window)
         except ValueError as e:
             logging.error(f'Failed to process {source} raw data: {e}')
             return False
-        thisGFA.data -= thisGFA.get_dark_current(ccdtemp, self.exptime)
         # Flag this camera if it appears to have excessive noise
         if thisGFA.nbad_overscan >= self.nbad_threshold:
             if camera not in self.noisy_gfa:
@@ -105,6 +105,8 @@ class GFACamera(object):
     nampx=1024
     nscan=50
     nxby2 = nampx + 2 * nscan
+    # Raw columns containing the overscans of all amplifiers, with E,H on the left and F,G on the right.
+    overscan_cols = slice(nampx + nscan, nampx + 3 * nscan)
     quad = {
         'E': (slice(None, nampy), slice(None, nampx)), # bottom left
         'H': (slice(nampy, None), slice(None, nampx)), # top left
@@ -166,7 +168,8 @@ class GFACamera(object):
         self.psf_centering = None
         self.donut_centering = None
 
-    def setraw(self, raw, name=None, overscan_correction=True, subtract_master_zero=True, apply_gain=True):
+    def setraw(self, raw, name=None, overscan_correction=True, subtract_master_zero=True, apply_gain=True,
+               row0=0, dark=None, window=None, overscan=None):
         """Initialize using the raw GFA data provided for a single exposure.
 
         After calling this method the following attributes are set:
@@ -184,12 +187,29 @@ class GFACamera(object):
             ivar : 2D array of float32
                 Inverse variance estimated in units matched to the data array.
 
-        To calculate the estimated dark current, use :meth:`get_dark_current`.  To remove the overscans
-        but not apply any calibrations, set all options to False.
+        The data and ivar arrays are views into the buffer allocated (or provided) in the constructor,
+        and are always updated in place, so no new image memory is allocated here.
+
+        To calculate the estimated dark current, use :meth:`get_dark_current` and pass the result
+        as the dark argument to have it subtracted here.  To remove the overscans but not apply
+        any calibrations, set all options to False.
+
+        The raw data can also be a band of full-width rows read from a larger image, e.g. to
+        only process the rows containing guide stars.  In this case, only the corresponding rows
+        of data and ivar are updated, and the bias of each amplifier is estimated from the
+        overscan rows within the band. The bias of an amplifier with no rows in the band is NaN.
+        To obtain the same bias as for the full frame, also provide the full-height overscan
+        columns, e.g. read with ``hdu[:, GFACamera.overscan_cols]``.
+
+        A window can also be specified to only update the data and ivar pixels within it, e.g. to
+        only process the union of the guide star stamps.  The bias is still estimated from the full
+        overscan of each amplifier, but pixels outside the window are not updated and should not
+        be used.
 
         Parameters:
             raw : numpy array
-                An array of raw data with shape (ny, nx). The raw input is not copied or modified.
+                An array of raw data with shape (ny, nx), or a band of full-width rows starting at
+                row0. The raw input is not copied or modified.
             name : str or None
                 Name of the camera that produced this raw data. Must be set to one of the values in gfa_names
                 in order to lookup the correct master zero and dark images, and amplifier parameters, when
@@ -201,23 +221,69 @@ class GFACamera(object):
                 Subtract the master zero image for this camera after applying overscan bias correction.
             apply_gain : bool
                 Convert from ADU to electrons using the gain specified for this camera.
+            row0 : int
+                Index of the first full-frame row contained in raw.
+            dark : numpy array or None
+                Full-frame image of the predicted dark current in electrons to subtract from the data,
+                after it has been used to estimate the Poisson variance. Requires apply_gain.
+            window : tuple or None
+                Tuple (ylo, yhi, xlo, xhi) of full-frame data pixel bounds to update, or None to update
+                all rows present in raw.
+            overscan : numpy array or None
+                Full-frame raw columns overscan_cols, with shape (2 * nampy, 2 * nscan), used to
+                estimate the bias of each amplifier instead of the overscan rows present in raw.
         """
         if raw.ndim != 2:
             raise ValueError('raw data must be 2D.')
+        if dark is not None and not apply_gain:
+            raise ValueError('Cannot subtract dark current in electrons without apply_gain.')
         raw_shape = (2 * self.nampy, 2 * self.nampx + 4 * self.nscan)
-        if raw.shape != raw_shape:
-            raise ValueError('raw data has dimensions {0} but expected {1}.'.format(raw.shape, raw_shape))
-        ny, nx = raw.shape
+        y1, y2 = row0, row0 + raw.shape[0]
+        if raw.shape[1] != raw_shape[1] or y1 < 0 or y2 > raw_shape[0] or y2 <= y1:
+            raise ValueError('raw data has dimensions {0} at row {1} but expected {2}.'.format(
+                raw.shape, row0, raw_shape))
+        if overscan is not None and overscan.shape != (raw_shape[0], 2 * self.nscan):
+            raise ValueError('overscan has dimensions {0} but expected {1}.'.format(
+                overscan.shape, (raw_shape[0], 2 * self.nscan)))
         if name not in self.gfa_names:
             logging.warning('Not a valid GFA name: {0}.'.format(name))
         self.name = name
-        # Create views (with no data copied) for each amplifier with rows and column in readout order.
-        self.amps = {
-            'E': raw[:self.nampy, :self.nxby2], # bottom left (using convention that raw[0,0] is bottom left)
-            'H': raw[-1:-(self.nampy + 1):-1, :self.nxby2], # top left
-            'F': raw[:self.nampy, -1:-(self.nxby2+1):-1], # bottom right
-            'G': raw[-1:-(self.nampy + 1):-1, -1:-(self.nxby2+1):-1], # top right
-        }
+        # Calculate the full-frame region of data pixels to update.
+        r1, r2, c1, c2 = y1, y2, 0, 2 * self.nampx
+        if window is not None:
+            ylo, yhi, xlo, xhi = window
+            r1, r2 = max(r1, ylo), min(r2, yhi)
+            c1, c2 = max(c1, xlo), min(c2, xhi)
+            if r2 <= r1 or c2 <= c1:
+                raise ValueError(f'Window {window} does not overlap raw data rows {y1}-{y2}.')
+        # Create views (with no data copied) for each amplifier with rows and column in readout order,
+        # using the convention that raw[0,0] is bottom left.  The first nrowtrim rows of each amplifier
+        # (in readout order) are trimmed, when present, before calculating its bias.
+        self.amps, quad, pixels, ntrim = {}, {}, {}, {}
+        for amp in self.amp_names:
+            top = amp in 'GH'
+            # Calculate the range of full-frame rows read by this amplifier that are present in raw.
+            lo, hi = (self.nampy, 2 * self.nampy) if top else (0, self.nampy)
+            lo = max(lo, y1)
+            hi = max(lo, min(hi, y2))
+            if top:
+                rows = slice(hi - 1 - y1, lo - 1 - y1 if lo > y1 else None, -1)
+                ntrim[amp] = max(0, hi - max(lo, 2 * self.nampy - self.nrowtrim))
+            else:
+                rows = slice(lo - y1, hi - y1)
+                ntrim[amp] = max(0, min(hi, self.nrowtrim) - lo)
+            cols = slice(-1, -(self.nxby2 + 1), -1) if amp in 'FG' else slice(None, self.nxby2)
+            self.amps[amp] = raw[rows, cols]
+            # Calculate the range of this amplifier's data pixels to update, and the raw columns
+            # that they are read from with the pre and post overscans removed.
+            right = amp in 'FG'
+            qlo = max(lo, r1)
+            qhi = max(qlo, min(hi, r2))
+            clo = max(self.nampx if right else 0, c1)
+            chi = max(clo, min(2 * self.nampx if right else self.nampx, c2))
+            offset = 3 * self.nscan if right else self.nscan
+            quad[amp] = (slice(qlo - r1, qhi - r1), slice(clo - c1, chi - c1))
+            pixels[amp] = raw[qlo - y1:qhi - y1, clo + offset:chi + offset]
         # Calculate bias as mean overscan, ignoring the first nrowtrim rows
         # (in readout order) and any values > maxdelta from the per-exposure median overscan.
         # Since we use a mean rather than median, subtracting this bias changes the dtype from
@@ -225,45 +291,60 @@ class GFACamera(object):
         self.bias = {}
         self.nbad_overscan = 0
         for amp in self.amp_names:
-            overscan = self.amps[amp][self.nrowtrim:, -self.nscan:]
-            delta = overscan - np.median(overscan)
+            if overscan is not None:
+                # Use the full-height overscan columns of this amplifier.
+                if amp in 'GH':
+                    rows = slice(self.nampy, 2 * self.nampy - self.nrowtrim)
+                else:
+                    rows = slice(self.nrowtrim, self.nampy)
+                cols = slice(self.nscan, None) if amp in 'FG' else slice(None, self.nscan)
+                scan = overscan[rows, cols]
+            else:
+                scan = self.amps[amp][ntrim[amp]:, -self.nscan:]
+            if scan.size == 0:
+                self.bias[amp] = np.nan
+                continue
+            delta = scan - np.median(scan)
             bad = np.abs(delta) > self.maxdelta
-            ngood = (self.nampy - self.nrowtrim) * self.nscan
+            ngood = scan.size
             if np.any(bad):
                 nbad = np.count_nonzero(bad)
                 logging.debug(f'Ignoring {nbad} bad overscan pixels for {name}-{amp}.')
-                overscan = np.copy(overscan)
-                overscan[bad] = 0.
+                scan = np.copy(scan)
+                scan[bad] = 0.
                 ngood -= nbad
                 self.nbad_overscan += nbad
-            self.bias[amp] = np.sum(overscan) / ngood
-        # Assemble the real pixel data with the pre and post overscans removed.
-        self.data[:self.nampy, :self.nampx] = raw[:self.nampy, self.nscan:self.nampx + self.nscan]
-        self.data[:self.nampy, self.nampx:] = raw[:self.nampy, self.nxby2 + self.nscan:-self.nscan]
-        self.data[self.nampy:, :self.nampx] = raw[self.nampy:, self.nscan:self.nampx + self.nscan]
-        self.data[self.nampy:, self.nampx:] = raw[self.nampy:, self.nxby2 + self.nscan:-self.nscan]
-        if overscan_correction:
-            # Apply the overscan bias corrections.
-            for amp in self.amp_names:
-                self.data[self.quad[amp]] -= self.bias[amp]
+            self.bias[amp] = np.sum(scan) / ngood
+        # Assemble the real pixel data with the pre and post overscans removed,
+        # applying the overscan bias corrections in the same pass if requested.
+        region = (slice(r1, r2), slice(c1, c2))
+        data, ivar = self.data[region], self.ivar[region]
+        for amp in self.amp_names:
+            if overscan_correction:
+                np.subtract(pixels[amp], self.bias[amp], out=data[quad[amp]])
+            else:
+                data[quad[amp]] = pixels[amp]
         # Subtract the master zero if requested.
         if subtract_master_zero:
-            self.data -= GFACamera.master_zero[name]
+            data -= GFACamera.master_zero[name][region]
         # Apply the gain correction if requested.
         if apply_gain:
             calib = GFACamera.calib_data[name]
             for amp in self.amp_names:
-                self.data[self.quad[amp]] *= calib[amp]['GAIN']
+                data[quad[amp]] *= calib[amp]['GAIN']
             # Use the calculated signal in elec as the estimate of Poisson variance.
-            self.ivar = np.maximum(self.data, 0, out=self.ivar)
+            np.maximum(data, 0, out=ivar)
             # Add the per-amplifier readnoise to the variance.
             for amp in self.amp_names:
                 rdnoise_in_elec = calib[amp]['RDNOISE'] * calib[amp]['GAIN']
-                self.ivar[self.quad[amp]] += rdnoise_in_elec ** 2
+                ivar[quad[amp]] += rdnoise_in_elec ** 2
             # Convert var to ivar in-place, avoiding divide by zero.
-            self.ivar = np.divide(1, self.ivar, out=self.ivar, where=self.ivar > 0)
+            np.divide(1, ivar, out=ivar, where=ivar > 0)
             # Zero ivar for any masked pixels.
-            self.ivar[self.pixel_mask[name]] = 0
+            ivar[self.pixel_mask[name][region]] = 0
+            # Subtract the dark current, which is included in the Poisson variance above.
+            if dark is not None:
+                data -= dark[region]
             self.unit = 'elec'
         else:
             self.unit = 'ADU'
@@ -308,7 +389,7 @@ class GFACamera(object):
         if name not in self.gfa_names:
             raise RuntimeError('Cannot subtract dark current from unknown camera: "{0}".'.format(name))
         master = self.master_dark[name]
-        calib = self.calib_data[self.name]
+        calib = self.calib_data[name]
         # Calculate the predicted and reference average dark currents in elec/s.
         if method == 'linear':
             # The IREF parameter cancels in the ratio.
@@ -507,6 +588,18 @@ def gfa_to_cs5(x_gfa, y_gfa, camera):
     return result[0] if scalar else result
 
 
+# Representative radii that sample the distribution of positioner radii on a petal
+# derived from $DESIMODEL/data/focalplane/fiberpos-all.ecsv
+rfibers = np.array(
+  [ 69.06885721, 129.05435611, 164.5269194 , 193.4449678 ,
+   216.78559103, 238.03225366, 258.75740161, 277.12360033,
+   293.66794588, 309.90058822, 325.98288641, 340.3077259 ,
+   354.16032478, 369.3513516 , 384.48016671, 399.65163889])
+
+# Platescales at each representative radius, which do not depend on the GFA position.
+rfiber_platescales = desietc.util.get_platescales(rfibers)
+
+
 def get_fiber_profile(x0, y0, camera, size, fiber_diam_um=107, pixel_size_um=15, nos=1):
     """Calculate the synthetic fiber profile centered at (x0,y0) in a GFA
     that represents a weighted average of platescale-corrected focal-plane
@@ -520,20 +613,11 @@ def get_fiber_profile(x0, y0, camera, size, fiber_diam_um=107, pixel_size_um=15,
     r0 = 0.5 * fiber_diam_um / pixel_size_um
     dYdth_gfa, dXdth_gfa = desietc.util.get_platescales(r_cs5)
 
-    # Representative radii that sample the distribution of positioner radii on a petal
-    # derived from $DESIMODEL/data/focalplane/fiberpos-all.ecsv
-    rfibers = np.array(
-      [ 69.06885721, 129.05435611, 164.5269194 , 193.4449678 ,
-       216.78559103, 238.03225366, 258.75740161, 277.12360033,
-       293.66794588, 309.90058822, 325.98288641, 340.3077259 ,
-       354.16032478, 369.3513516 , 384.48016671, 399.65163889])
-
-    fiber = np.zeros((size*nos, size*nos))
-    for rfiber in rfibers:
-        dYdth_fiber, dXdth_fiber = desietc.util.get_platescales(rfiber)
-        sx = dXdth_fiber / dXdth_gfa
-        sy = dYdth_fiber / dYdth_gfa
-        profile = lambda x, y: 1.0 * ((sx*x/nos) ** 2 + (sy*y/nos) ** 2 < r0 ** 2)
-        fiber += desietc.util.make_template(size*nos, profile, dx=(x0-ix)*nos, dy=(y0-iy)*nos, normalized=False)
-
-    return fiber / len(rfibers)
+    # Calculate the profiles for all representative radii with a single call.
+    dYdth_fiber, dXdth_fiber = rfiber_platescales
+    sx = dXdth_fiber / dXdth_gfa
+    sy = dYdth_fiber / dYdth_gfa
+    fiber = desietc.util.disk_pixel_coverage(
+        size*nos, r0, dx=(x0-ix)*nos, dy=(y0-iy)*nos, xscale=sx/nos, yscale=sy/nos)
+
+    return fiber.sum(axis=0) / len(rfibers)
@@ -3,6 +3,7 @@
 Used to model the PSF from sources detected in GFA images.
 """
 import logging
+import threading
 
 import numpy as np
 
@@ -11,6 +12,59 @@ import scipy.optimize
 
 import desietc.util
 
+try:
+    import desietc._kernels
+    numba_available = True
+except ImportError:
+    # Fallback to the pure numpy implementations.
+    numba_available = False
+
+# Whether the CUDA kernels can be used, or None until init_cuda() is called.
+cuda_available = None
+
+# Numba's default workqueue threading layer does not support concurrent launches
+# of parallel kernels, so calls from different threads are serialized. GPU kernel
+# launches use the same lock so that their transfers do not interleave.
+_kernel_lock = threading.Lock()
+
+
+def init_kernels():
+    """Initialize any compiled kernels from the calling thread.
+
+    Numba starts its threading layer on the first launch of a parallel kernel,
+    which must happen on the main thread to avoid a hang at interpreter exit
+    when kernels are subsequently called from worker threads.
+    Does nothing when numba is not available.
+    """
+    if not numba_available:
+        return
+    npixels = 4
+    dithered = np.ones((1, npixels), np.float32)
+    data = np.ones((1, npixels), np.float32)
+    ivar = np.ones((1, npixels), np.float32)
+    area = np.arange(npixels, dtype=float)
+    out = [np.empty((1, 1)) for i in range(3)]
+    with _kernel_lock:
+        desietc._kernels.fit_dither_nb(dithered, data, ivar, area, *out)
+
+
+def init_cuda():
+    """Import the CUDA kernels and check for a CUDA device, the first time this is called.
+
+    The import and device check are deferred until a CUDA backend is requested,
+    since they are slow and not needed for CPU-only processing.
+    Returns True if the CUDA backend can be used.
+    """
+    global cuda_available
+    if cuda_available is None:
+        try:
+            import desietc._cuda
+            cuda_available = desietc._cuda.is_available()
+        except ImportError:
+            # No CUDA support, so always use the CPU implementations.
+            cuda_available = False
+    return cuda_available
+
 
 class GMMFit(object):
 
@@ -57,11 +111,14 @@ class GMMFit(object):
     def gauss(self, mu1, mu2, sigma1, sigma2, rho, moments=False):
         """Calculate a single normalized Gaussian integrated over pixels.
 
+        The means can also be arrays of the same length N, to calculate N
+        Gaussians that only differ in their means with a single call.
+
         Parameters
         ----------
-        mu1 : float
+        mu1 : float or array
             Mean along x1
-        m2 : float
+        m2 : float or array
             Mean along x2
         sigma1 : float
             Standard deviation along x1. Must be > 0.
@@ -79,7 +136,8 @@ class GMMFit(object):
         -------
         array
             Array of shape (n2, n1) if moments is False, or (6, n2, n1)
-            if moments is True.
+            if moments is True.  When the means are arrays, an axis of
+            length N is inserted before the last two axes.
         """
         if sigma1 <= 0:
             raise ValueError('sigma1 must be > 0.')
@@ -87,11 +145,13 @@ class GMMFit(object):
             raise ValueError('sigma2 must be > 0.')
         if np.abs(rho) >= 1:
             raise ValueError('rho must be in (-1, +1).')
-        n2, n1 = self.shape
+        mu1 = np.asarray(mu1)[..., np.newaxis]
+        mu2 = np.asarray(mu2)[..., np.newaxis]
+        shape = np.broadcast(mu1, mu2).shape[:-1] + self.shape
         if moments:
-            result = np.zeros((6, n2, n1))
+            result = np.zeros((6,) + shape)
         else:
-            result = np.zeros((1, n2, n1))
+            result = np.zeros((1,) + shape)
 
         rho2 = rho ** 2
         c0 = 1 - rho2
@@ -104,11 +164,15 @@ class GMMFit(object):
         s2_edges = (self.x2_edges - mu2) / sigma2
 
         # Calculate midpoints and bin sizes, ready for broadcasting
-        # as axis=0 in 2D array expressions.
-        s1 = 0.5 * (s1_edges[1:] + s1_edges[:-1])[:, np.newaxis]
-        ds1 = 0.5 * (s1_edges[1:] - s1_edges[:-1])[:, np.newaxis]
-        s2 = 0.5 * (s2_edges[1:] + s2_edges[:-1])[:, np.newaxis]
-        ds2 = 0.5 * (s2_edges[1:] - s2_edges[:-1])[:, np.newaxis]
+        # as axis=-2 in 2D array expressions.
+        s1 = 0.5 * (s1_edges[..., 1:] + s1_edges[..., :-1])[..., np.newaxis]
+        ds1 = 0.5 * (s1_edges[..., 1:] - s1_edges[..., :-1])[..., np.newaxis]
+        s2 = 0.5 * (s2_edges[..., 1:] + s2_edges[..., :-1])[..., np.newaxis]
+        ds2 = 0.5 * (s2_edges[..., 1:] - s2_edges[..., :-1])[..., np.newaxis]
+
+        # Prepare edges for broadcasting as axis=-1 in 2D array expressions.
+        s1_edges = s1_edges[..., np.newaxis, :]
+        s2_edges = s2_edges[..., np.newaxis, :]
 
         for transpose in (True, False):
 
@@ -120,8 +184,8 @@ class GMMFit(object):
             ds1sq = ds1 ** 2
             s2_rho = s2_edges * rho
             term1 = -c1 * rho * ds1sq * np.diff(
-                exp_arg * (s2_rho - s1 * (2 - rho2)), axis=1)
-            erf_diff = np.diff(scipy.special.erf(arg), axis=1)
+                exp_arg * (s2_rho - s1 * (2 - rho2)), axis=-1)
+            erf_diff = np.diff(scipy.special.erf(arg), axis=-1)
             term2 = c2 * (6 + ds1sq * (s1sq - 1)) * erf_diff
             moment_0 = norm * (term1 + term2)
 
@@ -156,11 +220,11 @@ class GMMFit(object):
                 moment_s1s2 = norm * (term1 + term2)
 
             if transpose:
-                result[0] = 0.5 * moment_0.T
+                result[0] = 0.5 * np.swapaxes(moment_0, -1, -2)
                 if moments:
-                    result[1] = sigma1 * moment_s1.T
-                    result[3] = sigma1 ** 2 * moment_s1s1.T
-                    result[4] = 0.5 * sigma1 * sigma2 * moment_s1s2.T
+                    result[1] = sigma1 * np.swapaxes(moment_s1, -1, -2)
+                    result[3] = sigma1 ** 2 * np.swapaxes(moment_s1s1, -1, -2)
+                    result[4] = 0.5 * sigma1 * sigma2 * np.swapaxes(moment_s1s2, -1, -2)
                 # Swap coordinates to calculate series expansion in s2.
                 s1 = s2
                 ds1 = ds2
@@ -360,6 +424,38 @@ class GMMFit(object):
             final_params, _ = self.transform(final_params, forward=True)
         return final_params, result
 
+    def least_squares(self, initial_params, data, ivar, transformed=True, kwargs={}):
+        """Driver for scipy.optimize.least_squares with analytic partials and optional transforms.
+
+        The residuals are normalized so that their sum of squares equals the value
+        of :meth:`nll` (without any prior), which is therefore ``2 * result.cost``.
+        The Jacobian is calculated analytically using :meth:`predict` with
+        compute_partials set, and reused from the preceding residuals evaluation.
+        """
+        if transformed:
+            initial_params, _ = self.transform(initial_params, forward=False)
+        norm = np.sqrt(ivar / data.size).reshape(-1)
+        data = data.reshape(-1)
+        cache = {}
+
+        def residuals(p):
+            params, derivs = self.transform(p) if transformed else (p, 1)
+            predicted, partials = self.predict(params, compute_partials=True)
+            cache['p'] = p.copy()
+            cache['jac'] = (partials.reshape(len(p), -1) * norm).T * derivs
+            return (predicted.reshape(-1) - data) * norm
+
+        def jacobian(p):
+            if 'p' not in cache or not np.array_equal(p, cache['p']):
+                residuals(p)
+            return cache['jac']
+
+        result = scipy.optimize.least_squares(residuals, initial_params, jac=jacobian, **kwargs)
+        final_params = result.x if result.success else initial_params
+        if transformed:
+            final_params, _ = self.transform(final_params, forward=True)
+        return final_params, result
+
     def generate(self, params, ivar, seed=123):
         """Generate a random realization of a model with specified parameters.
         """
@@ -422,6 +518,10 @@ class GMMFit(object):
             dict(method='BFGS', jac=True, options={'gtol': 1e-2}),
             dict(method='Nelder-Mead', options={'xatol': 1e-2, 'fatol': 1e-2, 'maxiter': maxgauss * 1000}),
         )
+        if self.rhoprior_power == 0:
+            # Start with a least-squares fit using the analytic Jacobian, which only
+            # applies when the nll has no prior term.
+            methods = (dict(method='trf', ftol=1e-4, xtol=1e-4, max_nfev=100),) + methods
         # Calculate the image center.
         mu1 = 0.5 * (self.x1_edges[0] + self.x1_edges[-1])
         mu2 = 0.5 * (self.x2_edges[0] + self.x2_edges[-1])
@@ -451,16 +551,21 @@ class GMMFit(object):
                 for method in methods:
                     with np.errstate(all='raise'):
                         try:
-                            final_params, result = self.minimize(params, data, ivar, kwargs=method)
+                            if method['method'] == 'trf':
+                                final_params, result = self.least_squares(params, data, ivar, kwargs=method)
+                                nll = 2 * result.cost
+                            else:
+                                final_params, result = self.minimize(params, data, ivar, kwargs=method)
+                                nll = result.fun
                         except FloatingPointError as e:
                             if self.debug:
                                 logging.debug('minimize giving up after: {0}'.format(e))
                             continue
                     if self.debug:
-                        logging.debug(f'fit {ngauss}/{i} {method["method"]} {result.success} {result.fun:.4f} {best_nll:.4f}')
+                        logging.debug(f'fit {ngauss}/{i} {method["method"]} {result.success} {nll:.4f} {best_nll:.4f}')
                     if result.success:
-                        if result.fun < best_nll:
-                            best_nll = result.fun
+                        if nll < best_nll:
+                            best_nll = nll
                             best_params, best_result = final_params, result
                             if best_nll < threshold:
                                 if self.debug:
@@ -513,6 +618,8 @@ class GMMFit(object):
         -------
         array
             Array with shape (ndither, nx2, nx1) with predictions  at each dither.
+            Values are stored as float32 to halve the memory bandwidth needed to
+            scan all dithers in :meth:`fit_dithered_batch`.
         """
         xdither = np.asarray(xdither)
         ydither = np.asarray(ydither)
@@ -529,18 +636,13 @@ class GMMFit(object):
         # Zero any background offset.
         if base:
             params[0] = 0
-        # Remember the original means.
-        mu1 = params[base + 1::6].copy()
-        mu2 = params[base + 2::6].copy()
-        # Loop over dithers to generate an array of dithered models.
+        norm, mu1, mu2, sigma1, sigma2, rho = params[base:].reshape(-1, 6).T
+        # Accumulate all dithers of each Gaussian component with a single call.
         ndither = len(xdither)
-        dithered = np.empty((ndither,) + self.shape)
-        for k in range(ndither):
-            dx, dy = xdither[k], ydither[k]
-            params[base + 1::6] = mu1 + dx
-            params[base + 2::6] = mu2 + dy
-            dithered[k] = self.predict(params)
-        return dithered
+        dithered = np.zeros((ndither,) + self.shape)
+        for k in range(len(norm)):
+            dithered += norm[k] * self.gauss(mu1[k] + xdither, mu2[k] + ydither, sigma1[k], sigma2[k], rho[k])
+        return dithered.astype(np.float32)
 
     def fit_dithered(self, xdither, ydither, dithered, data, ivar):
         """Fit a dithered model to data with errors and return the estimated centroid, bg and flux.
@@ -566,39 +668,127 @@ class GMMFit(object):
         Returns
         -------
         tuple
-            Tuple (dx, dy, flux, bgdensity, nll, best_fit) of the best-fit centroid
+            Tuple (dx, dy, flux, bgdensity, nll, kmin) of the best-fit centroid
             offsets (dx, dy), integrated flux, background density, nll value per pixel,
-            and best-fit dither template.
+            and index of the best-fit dither template, dithered[kmin].
+        """
+        data = np.asarray(data)
+        ivar = np.asarray(ivar)
+        if data.shape != ivar.shape:
+            raise ValueError('Input data and ivar have different shapes.')
+        dx, dy, flux, bgdensity, nll, kmin = self.fit_dithered_batch(
+            xdither, ydither, dithered, data[np.newaxis], ivar[np.newaxis])
+        return dx[0], dy[0], flux[0], bgdensity[0], nll[0], kmin[0]
+
+    def fit_dithered_batch(self, xdither, ydither, dithered, data, ivar, tile_size=64, backend='cpu',
+                           dithered_device=None):
+        """Fit a dithered model to a batch of postage stamps.
+
+        Equivalent to calling :meth:`fit_dithered` for each stamp, but the dithered
+        templates are only traversed once for the whole batch. The best-fit flux and
+        background for each (dither, stamp) hypothesis are calculated in closed form
+        from the normal equations, so the NLL does not require the predicted pixels.
+        Uses the compiled kernel :func:`desietc._kernels.fit_dither_nb` when numba
+        is installed, or :func:`desietc._cuda.fit_dither_cuda` with backend='cuda'.
+
+        Parameters
+        ----------
+        xdither : array
+            1D array of N x offsets applied to the mean of each Gaussian component.
+        ydither : array
+            1D array of N y offsets applied to the mean of each Gaussian component.
+        dithered : array
+            Array with shape (N, nx2, nx1) usually obtained by calling :meth:`dither`.
+        data : array
+            3D array of shape (nstamp, nx2, nx1) with the observed pixel values.
+        ivar : array
+            3D array of corresponding pixel inverse variances.
+        tile_size : int
+            Number of dithers to process together when numba is not available.
+            The default of 64 dithers of 31x31 float32 pixels is a ~250Kb tile
+            that stays in L2 cache while it is used for every stamp. Sums are
+            always accumulated in float64.
+        backend : str
+            Use 'cuda' to run the fits on a GPU when :func:`init_cuda` has found one.
+            Otherwise the fits run on the CPU.
+        dithered_device : device array or None
+            Copy of dithered already on the GPU, obtained with :func:`desietc._cuda.to_device`,
+            to avoid copying the templates for each call with backend='cuda'.
+
+        Returns
+        -------
+        tuple
+            Tuple (dx, dy, flux, bgdensity, nll, kmin) of 1D arrays of length nstamp.
+            See :meth:`fit_dithered` for details.
         """
         xdither = np.asarray(xdither)
         ydither = np.asarray(ydither)
         if xdither.ndim != 1 or xdither.shape != ydither.shape:
             raise ValueError('Invalid inputs xdither, ydither.')
         ndither = len(xdither)
-        if dithered.shape != (ndither,) + data.shape:
-            raise ValueError('Input dithered array has unexpected shape.')
+        data = np.asarray(data)
+        ivar = np.asarray(ivar)
+        if data.ndim != 3 or data.shape[1:] != self.shape:
+            raise ValueError('Input data array has unexpected shape.')
         if data.shape != ivar.shape:
             raise ValueError('Input data and ivar have different shapes.')
-        # Calculate the best-fit flux and background for each offset hypothesis.
-        M11 = np.sum(ivar * dithered ** 2, axis=(1, 2))
-        M12 = np.sum(ivar * self.areas * dithered, axis=(1, 2))
-        M22 = np.sum(ivar * self.areas ** 2)
-        A1 = np.sum(ivar * data * dithered, axis=(1, 2))
-        A2 = np.sum(ivar * data * self.areas)
-        det = M11 * M22 - M12 ** 2
-        flux = (M22 * A1 - M12 * A2) / det
-        bgdensity = (M11 * A2 - M12 * A1) / det
-        # Calculate the corresponding NLL values.
-        S = (ndither, 1, 1)
-        pred = flux.reshape(S) * dithered + bgdensity.reshape(S) * self.areas
-        nll = 0.5 * np.sum(ivar * (data - pred) ** 2, axis=(1, 2))
-        # Find the offsets in (x, y) with the minimum nll.
-        kmin = np.argmin(nll)
+        if dithered.shape != (ndither,) + self.shape:
+            raise ValueError('Input dithered array has unexpected shape.')
+        nstamp, npixels = len(data), data[0].size
+        # Flatten the pixel axes.
+        M = dithered.reshape(ndither, npixels)
+        W = ivar.reshape(nstamp, npixels)
+        D = data.reshape(nstamp, npixels)
+        area = self.areas.reshape(npixels)
+        if backend == 'cuda' and cuda_available:
+            # Fit all (dither, stamp) pairs with a single GPU kernel launch.
+            nll = np.empty((ndither, nstamp))
+            flux = np.empty((ndither, nstamp))
+            bgdensity = np.empty((ndither, nstamp))
+            with _kernel_lock:
+                desietc._cuda.fit_dither(
+                    M if dithered_device is None else dithered_device, D, W, area, nll, flux, bgdensity)
+        elif numba_available:
+            # Use the compiled kernel that accumulates all sums in a single pass.
+            nll = np.empty((ndither, nstamp))
+            flux = np.empty((ndither, nstamp))
+            bgdensity = np.empty((ndither, nstamp))
+            with _kernel_lock:
+                desietc._kernels.fit_dither_nb(
+                    M, np.ascontiguousarray(D), np.ascontiguousarray(W), area, nll, flux, bgdensity)
+        else:
+            # Calculate the sums that do not depend on the dither.
+            W = W.astype(np.float64)
+            WD = W * D
+            WA = W * area
+            M22 = np.dot(W, area ** 2)
+            A2 = np.dot(WD, area)
+            WDD = np.sum(WD * D, axis=1)
+            # Calculate the best-fit flux and background for each (offset, stamp) hypothesis,
+            # processing one tile of dithers at a time.
+            nll = np.empty((ndither, nstamp))
+            flux = np.empty((ndither, nstamp))
+            bgdensity = np.empty((ndither, nstamp))
+            for lo in range(0, ndither, tile_size):
+                tile = slice(lo, lo + tile_size)
+                Mt = M[tile].astype(np.float64)
+                M11 = np.dot(Mt ** 2, W.T)
+                M12 = np.dot(Mt, WA.T)
+                A1 = np.dot(Mt, WD.T)
+                det = M11 * M22 - M12 ** 2
+                flux[tile] = (M22 * A1 - M12 * A2) / det
+                bgdensity[tile] = (M11 * A2 - M12 * A1) / det
+                # Calculate the corresponding NLL values using chisq = sum(W*D**2) - flux * A1 - bg * A2
+                # which holds at the best-fit flux and background.
+                nll[tile] = 0.5 * (WDD - flux[tile] * A1 - bgdensity[tile] * A2)
+        # Find the offsets in (x, y) with the minimum nll for each stamp.
+        kmin = np.argmin(nll, axis=0)
+        istamp = np.arange(nstamp)
         return (
             xdither[kmin], ydither[kmin],
-            flux[kmin], bgdensity[kmin],
-            nll[kmin] / data.size,
-            dithered[kmin])
+            flux[kmin, istamp], bgdensity[kmin, istamp],
+            nll[kmin, istamp] / npixels,
+            kmin)
 
 
 def print_params(params):
@@ -200,7 +200,11 @@ def replay_exposure(ETC, path, expid, outpath, req_efftime=1000, sbprof='ELG',
             if frame['num'] == 0 and F['acq_path'].exists():
                 data = acq_to_online(F['acq_path'], desietc.gfa.GFACamera.guide_names)
             else:
-                data = fits_to_online(F['gfa_path'], desietc.gfa.GFACamera.guide_names, frame['num'])
+                # Only read the rows of a guide frame (but not an acquisition image) that contain guide stars.
+                rowrange = {}
+                if frame['num'] > 0:
+                    rowrange = {camera: bbox[:2] for camera, bbox in ETC.stamp_bbox.items()}
+                data = fits_to_online(F['gfa_path'], desietc.gfa.GFACamera.guide_names, frame['num'], rowrange)
             if frame['num'] == 0:
                 # Process the acquisition image.
                 ETC.process_acquisition(data)
@@ -259,9 +263,12 @@ def acq_to_online(path, names):
     return online
 
 
-def fits_to_online(path, names, frame):
+def fits_to_online(path, names, frame, rowrange={}):
     """Read a FITS file and prepare a dictionary containing its headers and arrays
     in the same format used by the DESI online software.
+    Only the full-width rows [row0:row1] are read for any extension with an
+    entry (row0, row1) in rowrange, and row0 is included with its data, together
+    with the full-height overscan columns so that the bias matches a full frame.
     """
     online = {}
     with fitsio.FITS(str(path)) as hdus:
@@ -273,17 +280,22 @@ def fits_to_online(path, names, frame):
             if ext not in hdus or ext + 'T' not in hdus:
                 continue
             dims = hdus[ext].get_dims()
+            row0, row1 = rowrange.get(ext, (0, None))
             if len(dims) == 2:
                 if frame != 0:
                     raise ValueError(f'Requested frame {frame} when no frames present.')
-                data = hdus[ext][:,:]
+                data = hdus[ext][row0:row1,:]
             elif len(dims) == 3:
                 if frame >= dims[0]:
                     raise ValueError(f'Requested non-existent frame {frame}.')
-                data = hdus[ext][frame,:,:][0]
+                data = hdus[ext][frame,row0:row1,:][0]
             else:
                 raise ValueError(f'Data has invalid dimensions: {dims}.')
             table = hdus[ext + 'T'][frame]
             hdr = {key: table[key] for key in table.dtype.names}
             online[ext] = dict(header=hdr, data=data)
+            if ext in rowrange:
+                cols = desietc.gfa.GFACamera.overscan_cols
+                online[ext]['row0'] = row0
+                online[ext]['overscan'] = hdus[ext][:,cols] if len(dims) == 2 else hdus[ext][frame,:,cols][0]
     return online
@@ -527,6 +527,57 @@ def make_template(size, profile, dx=0, dy=0, oversampling=10, normalized=True):
     return T
 
 
+def disk_pixel_coverage(size, radius, dx=0, dy=0, xscale=1, yscale=1):
+    """Calculate the exact fraction of each pixel covered by an elliptical disk.
+
+    The disk covers the region (xscale * x) ** 2 + (yscale * y) ** 2 < radius ** 2
+    using the same pixel coordinates and offset conventions as :func:`make_template`,
+    so the result is the infinite oversampling limit of::
+
+        make_template(size, profile, dx, dy, normalized=False)
+
+    for the corresponding binary profile. The area of the disk within each pixel is
+    calculated analytically by combining circular-segment integrals at the pixel corners.
+
+    Parameters
+    ----------
+    size : int
+        Output 2D array will have shape (size, size).
+    radius : float
+        Radius of the disk in scaled pixel coordinates.
+    dx : float
+        Offset of the disk center along x (in pixels).
+    dy : float
+        Offset of the disk center along y (in pixels).
+    xscale : float or array
+        Scale factor applied to x pixel coordinates. Must be > 0.
+    yscale : float or array
+        Scale factor applied to y pixel coordinates. Must be > 0.
+
+    Returns
+    -------
+    array
+        2D numpy array of covered pixel fractions in the range [0,1] with shape (size, size).
+        When xscale or yscale are arrays, their broadcast shape is prepended to this shape.
+    """
+    rsq = radius ** 2
+    # Calculate the scaled pixel edge coordinates relative to the disk center.
+    edges = np.arange(size + 1) - 0.5 * size
+    xscale = np.asarray(xscale)[..., np.newaxis, np.newaxis]
+    yscale = np.asarray(yscale)[..., np.newaxis, np.newaxis]
+    u = xscale * (edges - dx)
+    v = yscale * (edges - dy).reshape(-1, 1)
+    # Calculate the signed area of the disk within [0,u] x [0,v] at each pixel corner.
+    a = np.minimum(np.abs(u), radius)
+    b = np.minimum(np.abs(v), radius)
+    c = np.minimum(a, np.sqrt(rsq - b ** 2))
+    S = lambda z: 0.5 * (z * np.sqrt(rsq - z ** 2) + rsq * np.arcsin(z / radius))
+    G = np.sign(u) * np.sign(v) * (b * c + S(a) - S(c))
+    # Combine corners to get the area within each pixel.
+    area = np.diff(np.diff(G, axis=-2), axis=-1)
+    return area / (xscale * yscale)
+
+
 def preprocess(D, W, nsig_lo=10, nsig_hi=30, vmin=None, vmax=None):
     """Preprocess weighted 2D array data for display.
     """
@@ -1109,10 +1160,11 @@ def pwlinear_solve(t, dt, yint):
     return scipy.linalg.solve_banded((1,1), banded, yint)
 
 
+# The convolution kernels below are float32 so that they preserve the dtype of float32 GFA stamps.
 _blur_kernel = np.array([
     [1.8584491e-07, 4.3132287e-04, 1.8588798e-07],
     [4.3132226e-04, 9.9827397e-01, 4.3132226e-04],
-    [1.8588798e-07, 4.3132287e-04, 1.8584491e-07]])
+    [1.8588798e-07, 4.3132287e-04, 1.8584491e-07]], np.float32)
 
 def blur(D, W):
     """Apply a weighted 0.15-pixel Gaussian blur to reduce the impact of any
@@ -1135,7 +1187,7 @@ _ELG_kernel = np.array([
     [0.0013665164588019252, 0.0028473353013396263, 0.005736198276281357, 0.010810506530106068, 0.017641831189393997, 0.021501323208212852, 0.017641831189393997, 0.010810506530106068, 0.005736198276281357, 0.0028473353013396263, 0.0013665164588019252],
     [0.0010057131294161081, 0.001976282801479101, 0.0036765243858098984, 0.006234399974346161, 0.00904802419245243, 0.010399244725704193, 0.00904802419245243, 0.006234399974346161, 0.0036765243858098984, 0.001976283034309745, 0.0010057131294161081],
     [0.0006760309333913028, 0.0012480159057304263, 0.0021513437386602163, 0.003348887199535966, 0.0045022256672382355, 0.0049937451258301735, 0.0045022256672382355, 0.003348887199535966, 0.0021513437386602163, 0.0012480159057304263, 0.0006760309333913028],
-    [0.0004233430081512779, 0.0007364505436271429, 0.001188363297842443, 0.0017316826852038503, 0.0022099444177001715, 0.002399129094555974, 0.0022099444177001715, 0.0017316826852038503, 0.001188363297842443, 0.0007364505436271429, 0.0004233430081512779]])
+    [0.0004233430081512779, 0.0007364505436271429, 0.001188363297842443, 0.0017316826852038503, 0.0022099444177001715, 0.002399129094555974, 0.0022099444177001715, 0.0017316826852038503, 0.001188363297842443, 0.0007364505436271429, 0.0004233430081512779]], np.float32)
 
 # 11x11 convolution kernel for the nominal BGS profile which is round Sersic n=4 with 1.5" half-light radius.
 # This kernel is stretched by 1.084 along y and squeezed by 0.922 along x to account for the different plate scales.
@@ -1151,12 +1203,13 @@ _BGS_kernel = np.array([
     [0.0014565379824489355, 0.0020129659678786993, 0.002877740887925029, 0.004214275162667036, 0.0059745050966739655, 0.006993815768510103, 0.0059745050966739655, 0.004214275162667036, 0.002877740887925029, 0.0020129659678786993, 0.0014565379824489355],
     [0.0012624080991372466, 0.0016604403499513865, 0.002200713846832514, 0.002877740887925029, 0.003545331070199609, 0.0038440146017819643, 0.003545331070199609, 0.002877740887925029, 0.002200713846832514, 0.0016604403499513865, 0.0012624080991372466],
     [0.0010629459284245968, 0.0013336124829947948, 0.0016604403499513865, 0.0020129659678786993, 0.002308456925675273, 0.002431850880384445, 0.002308456925675273, 0.0020129659678786993, 0.0016604403499513865, 0.001333612366579473, 0.0010629459284245968],
-    [0.0008819324430078268, 0.0010629459284245968, 0.0012624080991372466, 0.0014565379824489355, 0.00160425144713372, 0.0016609467566013336, 0.00160425144713372, 0.0014565379824489355, 0.0012624080991372466, 0.0010629459284245968, 0.0008819324430078268]])
+    [0.0008819324430078268, 0.0010629459284245968, 0.0012624080991372466, 0.0014565379824489355, 0.00160425144713372, 0.0016609467566013336, 0.00160425144713372, 0.0014565379824489355, 0.0012624080991372466, 0.0010629459284245968, 0.0008819324430078268]], np.float32)
 
 def get_fiber_fractions(PSF, FIBER):
     """Given a PSF postage stamp observed in a GFA and a fiber profile, return the (PSF,ELG,BGS) fiber fractions.
     """
-    PSFsum = np.sum(PSF)
+    PSFsum = np.sum(PSF, dtype=np.float64)
     ELG = scipy.signal.convolve(PSF, _ELG_kernel, mode='same')
     BGS = scipy.signal.convolve(PSF, _BGS_kernel, mode='same')
-    return np.sum(PSF * FIBER) / PSFsum, np.sum(ELG * FIBER) / PSFsum, np.sum(BGS * FIBER) / PSFsum
+    return (np.sum(PSF * FIBER, dtype=np.float64) / PSFsum, np.sum(ELG * FIBER, dtype=np.float64) / PSFsum,
+            np.sum(BGS * FIBER, dtype=np.float64) / PSFsum)